@@ -11,7 +11,7 @@ import argparse
 import host
 from logger import logger
 from clusterSnapshotter import ClusterSnapshotter
-from virtualBridge import VirBridge
+from virtualBridge import VirBridge, VirBridgeError
 import configLoader
 from cdaConfig import CdaConfig
 import auth
@@ -132,10 +132,13 @@ def main() -> None:
 
     sf = StateFile(cc.name, conf.state_file_path)
 
-    if args.subcommand == "deploy":
-        main_deploy(args, cc, conf, sf)
-    elif args.subcommand == "snapshot":
-        main_snapshot(args, cc, sf)
+    try:
+        if args.subcommand == "deploy":
+            main_deploy(args, cc, conf, sf)
+        elif args.subcommand == "snapshot":
+            main_snapshot(args, cc, sf)
+    except VirBridgeError as e:
+        logger.error_and_exit(str(e))
 
 
 if __name__ == "__main__":
@@ -78,6 +78,14 @@ class ClusterDeployer(BaseDeployer):
     def _all_hosts_with_workers(self) -> set[ClusterHost]:
         return {ch for ch in self._all_hosts if len(ch.k8s_worker_nodes) > 0}
 
+    def _configure_bridges(self, hosts: set[ClusterHost]) -> None:
+        # Every host has its own bridge, configure them concurrently rather than one host after the other.
+        if not hosts:
+            return
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            for future in [executor.submit(h.configure_bridge) for h in hosts]:
+                future.result()
+
     def _all_hosts_with_only_workers(self) -> set[ClusterHost]:
         return {ch for ch in self._all_hosts if len(ch.k8s_worker_nodes) > 0 and not ch.k8s_master_nodes}
 
@@ -334,8 +342,7 @@ class ClusterDeployer(BaseDeployer):
         # NOTE: linking the network must happen before starting masters because
         # they need to be able to access the DHCP server running on the
         # provisioning node.
-        for h in hosts_with_masters:
-            h.configure_bridge()
+        self._configure_bridges(hosts_with_masters)
 
         self._local_host.setup_dhcp_entries(self._cc.masters)
         for h in hosts_with_masters:
@@ -402,8 +409,7 @@ class ClusterDeployer(BaseDeployer):
         # NOTE: linking the network must happen before starting workers because
         # they need to be able to access the DHCP server running on the
         # provisioning node.
-        for h in hosts_with_workers:
-            h.configure_bridge()
+        self._configure_bridges(hosts_with_workers)
 
         self._local_host.setup_dhcp_entries(self._cc.workers)
         for h in hosts_with_workers:
@@ -1,13 +1,16 @@
 from os import path, getcwd
 import os
-import io
 import sys
+import copy
+import functools
+import itertools
 import re
 import ipaddress
 from typing import Optional, Union
 import xml.etree.ElementTree as et
 import jinja2
-from yaml import safe_load
+import jinja2.runtime
+import yaml
 from auth import RegistryInfo
 import host
 from logger import logger
@@ -18,6 +21,21 @@ from dataclasses import dataclass, field
 from bmc import BmcConfig
 from imageRegistry import RegistryType
 
+# Prefer the libyaml backed loader when available, it is significantly faster.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Defaults for top level cluster config keys left out from the yaml.
+_CC_DEFAULTS: tuple[tuple[str, Union[None, str, list[dict[str, str]]]], ...] = (
+    ("masters", []),
+    ("workers", []),
+    ("preconfig", []),
+    ("postconfig", []),
+    ("proxy", None),
+    ("hosts", [{"name": "localhost"}]),
+    ("ip_range", "192.168.122.1-192.168.122.254"),
+    ("ip_mask", "255.255.0.0"),
+)
+
 
 def base_iso_path(cluster_name: str) -> str:
     return f"/home/{cluster_name}_guests_images"
@@ -341,7 +359,7 @@ class ClustersConfig:
         last_ip = self.get_last_ip()
 
         # Update the last IP based on the config.
-        for node in self.all_nodes():
+        for node in itertools.chain(self.masters, self.workers):
             if node.ip and last_ip and ipaddress.IPv4Address(node.ip) > ipaddress.IPv4Address(last_ip):
                 last_ip = node.ip
 
@@ -360,7 +378,7 @@ class ClustersConfig:
     def get_last_ip(self) -> str | None:
         hostconn = host.LocalHost()
         last_ip = "0.0.0.0"
-        xml_str = hostconn.run("virsh net-dumpxml default").out
+        xml_str = hostconn.run("virsh net-dumpxml default --inactive").out
         if xml_str.strip():
             tree = et.fromstring(xml_str)
             ip_tree = next((it for it in tree.iter("ip")), et.Element(''))
@@ -373,36 +391,19 @@ class ClustersConfig:
 
     def set_cc_defaults(self, cc: dict[str, Union[None, str, list[dict[str, str]]]]) -> None:
         # Some config may be left out from the yaml. Try to provide defaults.
-        if "masters" not in cc:
-            cc["masters"] = []
-        if "workers" not in cc:
-            cc["workers"] = []
-        if "kubeconfig" not in cc:
-            cc["kubeconfig"] = path.join(getcwd(), f'kubeconfig.{cc["name"]}')
-        if "preconfig" not in cc:
-            cc["preconfig"] = []
-        if "postconfig" not in cc:
-            cc["postconfig"] = []
-        if "proxy" not in cc:
-            cc["proxy"] = None
-        if "hosts" not in cc:
-            cc["hosts"] = [{"name": "localhost"}]
-        if "ip_range" not in cc:
-            cc["ip_range"] = "192.168.122.1-192.168.122.254"
-        if "ip_mask" not in cc:
-            cc["ip_mask"] = "255.255.0.0"
+        for key, default in _CC_DEFAULTS:
+            if key not in cc:
+                cc[key] = copy.deepcopy(default)
+        cc.setdefault("kubeconfig", path.join(getcwd(), f'kubeconfig.{cc["name"]}'))
 
     def set_cc_hosts_defaults(self, cc: dict[str, list[dict[str, str]]]) -> None:
         # creates hosts entries for each referenced node name
-        node_names = {x["name"] for x in cc["hosts"]}
-        for node in self.all_nodes():
-            if node.node not in node_names:
-                cc["hosts"].append({"name": node.node})
-                node_names.add(node.node)
+        known_names = {x["name"] for x in cc["hosts"]}
+        referenced_names = dict.fromkeys(node.node for node in self.all_nodes())
+        cc["hosts"].extend({"name": name} for name in referenced_names if name not in known_names)
 
         for e in cc["hosts"]:
-            if "network_api_port" not in e:
-                e["network_api_port"] = self.network_api_port
+            e.setdefault("network_api_port", self.network_api_port)
 
     def _load_full_config(self, yaml_path: str) -> None:
         if not path.exists(yaml_path):
@@ -413,9 +414,13 @@ class ClustersConfig:
             contents = f.read()
             # load it twice, to get the name of the cluster so
             # that that can be used as a var
-            loaded = safe_load(io.StringIO(contents))["clusters"][0]
+            loaded = yaml.load(contents, Loader=YamlLoader)["clusters"][0]
+            if not any(marker in contents for marker in ("{{", "{%", "{#")):
+                # Nothing to expand, skip jinja and the second parse.
+                self.fullConfig = loaded
+                return
             contents = self._apply_jinja(contents, loaded["name"])
-            self.fullConfig = safe_load(io.StringIO(contents))["clusters"][0]
+            self.fullConfig = yaml.load(contents, Loader=YamlLoader)["clusters"][0]
 
     def _check_deprecated_config(self) -> None:
         # All configurations that used to be supported but are not anymore.
@@ -455,88 +460,15 @@ class ClustersConfig:
                 return False
             return True
 
-        if not all(validate_node_ip(n) for n in self.masters + self.configured_workers):
+        if not all(validate_node_ip(n) for n in itertools.chain(self.masters, self.configured_workers)):
             logger.error(f"Not all master/worker IPs are in the reserved cluster IP range ({self.ip_range}).  Other hosts in the network might be offered those IPs via DHCP.")
 
     def validate_external_port(self) -> bool:
         return bool(common.ip_links(host.LocalHost(), ifname=self.get_external_port()))
 
     def _apply_jinja(self, contents: str, cluster_name: str) -> str:
-        def worker_number(a: int) -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            name = self._cluster_info.workers[a]
-            lab_match = re.search(r"lab(\d+)", name)
-            if lab_match:
-                return lab_match.group(1)
-            else:
-                return re.sub("[^0-9]", "", name)
-
-        def worker_name(a: int) -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.workers[a]
-
-        def bmc(a: int) -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.bmcs[a]
-
-        def primary_network_port() -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.primary_network_port
-
-        def secondary_network_port() -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.secondary_network_port
-
-        def iso_server() -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.iso_server
-
-        def activation_key() -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.activation_key
-
-        def organization_id() -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.organization_id
-
-        def bmc_hostname(a: int) -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.bmc_hostname[a]
-
-        def dpu_mac_address(a: int) -> str:
-            self._ensure_clusters_loaded()
-            assert self._cluster_info is not None
-            return self._cluster_info.dpu_mac_addresses[a]
-
-        env = jinja2.Environment()
-
-        env.globals['worker_number'] = worker_number
-        env.globals['worker_name'] = worker_name
-        env.globals['primary_network_port'] = primary_network_port
-        env.globals['api_network'] = primary_network_port
-        env.globals['secondary_network_port'] = secondary_network_port
-        env.globals['iso_server'] = iso_server
-        env.globals['bmc'] = bmc
-        env.globals['activation_key'] = activation_key
-        env.globals['organization_id'] = organization_id
-        env.globals['bmc_hostname'] = bmc_hostname
-        env.globals['DPU_mac_address'] = dpu_mac_address
-
-        kwargs = {}
-        kwargs["cluster_name"] = cluster_name
-
-        template = env.from_string(contents)
-
-        t: str = template.render(**kwargs)
+        template = _jinja_template(contents)
+        t: str = template.render(cluster_name=cluster_name, _clusters_config=self)
         return t
 
     def _ensure_clusters_loaded(self) -> None:
@@ -547,7 +479,7 @@ class ClustersConfig:
         return self.masters + self.workers
 
     def all_vms(self) -> list[NodeConfig]:
-        return [x for x in self.all_nodes() if x.kind == "vm"]
+        return [x for x in itertools.chain(self.masters, self.workers) if x.kind == "vm"]
 
     def worker_vms(self) -> list[NodeConfig]:
         return [x for x in self.workers if x.kind == "vm"]
@@ -556,10 +488,10 @@ class ClustersConfig:
         return [x for x in self.masters if x.kind == "vm"]
 
     def local_vms(self) -> list[NodeConfig]:
-        return [x for x in self.all_vms() if x.node == "localhost"]
+        return [x for x in itertools.chain(self.masters, self.workers) if x.kind == "vm" and x.node == "localhost"]
 
     def local_worker_vms(self) -> list[NodeConfig]:
-        return [x for x in self.worker_vms() if x.node == "localhost"]
+        return [x for x in self.workers if x.kind == "vm" and x.node == "localhost"]
 
     def is_sno(self) -> bool:
         return len(self.masters) == 1 and self.kind == "openshift"
@@ -602,6 +534,94 @@ class ClustersConfig:
                 logger.info(f"Node '{registry_node.name}' is baremetal - registry will use hostpath storage on existing disk")
 
 
+_LAB_NUMBER_RE = re.compile(r"lab(\d+)")
+_NON_DIGIT_RE = re.compile("[^0-9]")
+
+
+def _jinja_cluster_info(ctx: jinja2.runtime.Context) -> ClusterInfo:
+    cc: ClustersConfig = ctx["_clusters_config"]
+    cc._ensure_clusters_loaded()
+    assert cc._cluster_info is not None
+    return cc._cluster_info
+
+
+@jinja2.pass_context
+def _jinja_worker_number(ctx: jinja2.runtime.Context, a: int) -> str:
+    name = _jinja_cluster_info(ctx).workers[a]
+    lab_match = _LAB_NUMBER_RE.search(name)
+    if lab_match:
+        return lab_match.group(1)
+    else:
+        return _NON_DIGIT_RE.sub("", name)
+
+
+@jinja2.pass_context
+def _jinja_worker_name(ctx: jinja2.runtime.Context, a: int) -> str:
+    return _jinja_cluster_info(ctx).workers[a]
+
+
+@jinja2.pass_context
+def _jinja_bmc(ctx: jinja2.runtime.Context, a: int) -> str:
+    return _jinja_cluster_info(ctx).bmcs[a]
+
+
+@jinja2.pass_context
+def _jinja_primary_network_port(ctx: jinja2.runtime.Context) -> str:
+    return _jinja_cluster_info(ctx).primary_network_port
+
+
+@jinja2.pass_context
+def _jinja_secondary_network_port(ctx: jinja2.runtime.Context) -> str:
+    return _jinja_cluster_info(ctx).secondary_network_port
+
+
+@jinja2.pass_context
+def _jinja_iso_server(ctx: jinja2.runtime.Context) -> str:
+    return _jinja_cluster_info(ctx).iso_server
+
+
+@jinja2.pass_context
+def _jinja_activation_key(ctx: jinja2.runtime.Context) -> str:
+    return _jinja_cluster_info(ctx).activation_key
+
+
+@jinja2.pass_context
+def _jinja_organization_id(ctx: jinja2.runtime.Context) -> str:
+    return _jinja_cluster_info(ctx).organization_id
+
+
+@jinja2.pass_context
+def _jinja_bmc_hostname(ctx: jinja2.runtime.Context, a: int) -> str:
+    return _jinja_cluster_info(ctx).bmc_hostname[a]
+
+
+@jinja2.pass_context
+def _jinja_dpu_mac_address(ctx: jinja2.runtime.Context, a: int) -> str:
+    return _jinja_cluster_info(ctx).dpu_mac_addresses[a]
+
+
+# Shared by all ClustersConfig instances. The globals look up the cluster info
+# through the "_clusters_config" variable passed in when rendering.
+_jinja_env = jinja2.Environment()
+_jinja_env.globals['worker_number'] = _jinja_worker_number
+_jinja_env.globals['worker_name'] = _jinja_worker_name
+_jinja_env.globals['primary_network_port'] = _jinja_primary_network_port
+_jinja_env.globals['api_network'] = _jinja_primary_network_port
+_jinja_env.globals['secondary_network_port'] = _jinja_secondary_network_port
+_jinja_env.globals['iso_server'] = _jinja_iso_server
+_jinja_env.globals['bmc'] = _jinja_bmc
+_jinja_env.globals['activation_key'] = _jinja_activation_key
+_jinja_env.globals['organization_id'] = _jinja_organization_id
+_jinja_env.globals['bmc_hostname'] = _jinja_bmc_hostname
+_jinja_env.globals['DPU_mac_address'] = _jinja_dpu_mac_address
+
+
+@functools.lru_cache(maxsize=None)
+def _jinja_template(contents: str) -> jinja2.Template:
+    # Compiling the template is the expensive part, reuse it for identical configs.
+    return _jinja_env.from_string(contents)
+
+
 def main() -> None:
     pass
 
@@ -635,6 +635,13 @@ def current_host() -> str:
     chost = os.environ.get("CDA_CURRENT_HOST")
     if chost:
         return chost
+    # Resolve the canonical name like "hostname -f" does, without forking it.
+    try:
+        c = socket.getaddrinfo(socket.gethostname(), None, flags=socket.AI_CANONNAME)[0][3]
+    except OSError:
+        c = ""
+    if c:
+        return c
     lh = host.LocalHost()
     res = lh.run("hostname -f")
     if res.returncode == 0 and (c := res.out.strip()):
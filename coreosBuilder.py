@@ -1,13 +1,27 @@
 import os
+import re
 import sys
 import json
 import shutil
-from typing import Optional
+import functools
+import hashlib
+from typing import Any, Callable, Optional
 import glob
 from git.repo import Repo
 from logger import logger
 import host
 
+try:
+    # orjson parses the (large) manifest lock much faster, use it when available.
+    import orjson
+
+    _json_loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+_FCOS_PACKAGES_RE = re.compile(r"- (python3|python3-libs|perl|perl-interpreter)\n")
+_FCOS_PACKAGES_COMMENTED_RE = re.compile(r"# (python3|python3-libs|perl|perl-interpreter)\n")
+
 
 def ensure_fcos_exists(dst: str = "/root/iso/fedora-coreos.iso") -> None:
     logger.info("ensuring that fcos exists")
@@ -69,6 +83,20 @@ The "final iso location" is the image we will use to live boot our machines.
 """
 
 
+@functools.lru_cache(maxsize=4)
+def _ignition_for_keys(key_files: tuple[tuple[str, int], ...]) -> str:
+    # Keyed on (path, mtime) of the public keys, so they are only read again when they change.
+    keys = []
+    for file, _ in key_files:
+        logger.info(f"appending key from {file}")
+        with open(file, 'r') as f:
+            # strip the trailing comment
+            keys.append(f.read().rpartition(" ")[0])
+
+    ign = {"ignition": {"version": "3.3.0"}, "passwd": {"users": [{"name": "core", "sshAuthorizedKeys": keys}]}}
+    return json.dumps(ign)
+
+
 class CoreosBuilder:
     def __init__(self, working_dir: str):
         self._workdir = working_dir
@@ -96,32 +124,17 @@ class CoreosBuilder:
             contents = f.read()
         to_include = "\n  - custom.yaml"
 
-        include_start = contents.index("include:")
-        include_end = contents.index("\n", include_start)
-        before = contents[:include_end]
-        after = contents[include_end:]
-        if not after.startswith(to_include):
-            contents = before + to_include + after
+        # Add custom.yaml as the first entry of the include list, unless it is there already.
+        include_end = contents.index("\n", contents.index("include:"))
+        if not contents.startswith(to_include, include_end):
+            contents = contents[:include_end] + to_include + contents[include_end:]
 
-        coreos_yaml = os.path.join(config_dir, 'manifests/fedora-coreos.yaml')
-        logger.debug(f"modifying {coreos_yaml}")
-        with open(coreos_yaml, 'r') as f:
-            core_content = f.read()
-        old_str = "- python3\n"
-        core_content = core_content.replace(old_str, "# python3\n")
-        old_str = "- python3-libs\n"
-        core_content = core_content.replace(old_str, "# python3-libs\n")
-        old_str = "- perl\n"
-        core_content = core_content.replace(old_str, "# perl\n")
-        old_str = "- perl-interpreter\n"
-        core_content = core_content.replace(old_str, "# perl-interpreter\n")
-        with open(coreos_yaml, "w") as f:
-            f.write(core_content)
+        self._toggle_fcos_packages(config_dir, comment=True)
 
         logger.info(os.getcwd())
         manifest_lock = os.path.join(config_dir, "manifest-lock.x86_64.json")
-        with open(manifest_lock) as f:
-            j = json.load(f)
+        with open(manifest_lock, "rb") as lock_file:
+            j = _json_loads(lock_file.read())
             j["packages"]["kernel-modules-extra"] = j["packages"]["kernel"]
 
         with open(manifest_lock, "w") as f:
@@ -171,18 +184,18 @@ class CoreosBuilder:
         os.chdir(cur_dir)
 
         # cleanup
+        self._toggle_fcos_packages(config_dir, comment=False)
+
+    def _toggle_fcos_packages(self, config_dir: str, *, comment: bool) -> None:
+        # Comment out (or restore) the python3 and perl packages in fedora-coreos.yaml.
         coreos_yaml = os.path.join(config_dir, 'manifests/fedora-coreos.yaml')
         logger.info(f"modifying {coreos_yaml}")
         with open(coreos_yaml, 'r') as f:
             core_content = f.read()
-        old_str = "# python3\n"
-        core_content = core_content.replace(old_str, "- python3\n")
-        old_str = "# python3-libs\n"
-        core_content = core_content.replace(old_str, "- python3-libs\n")
-        old_str = "# perl\n"
-        core_content = core_content.replace(old_str, "- perl\n")
-        old_str = "# perl-interpreter\n"
-        core_content = core_content.replace(old_str, "- perl-interpreter\n")
+        if comment:
+            core_content = _FCOS_PACKAGES_RE.sub(r"# \1\n", core_content)
+        else:
+            core_content = _FCOS_PACKAGES_COMMENTED_RE.sub(r"- \1\n", core_content)
         with open(coreos_yaml, "w") as f:
             f.write(core_content)
 
@@ -198,15 +211,11 @@ class CoreosBuilder:
 
         cmd = f"coreos-installer iso ignition embed -i {fn_ign} -o {dst} {embed_src}"
         lh = host.LocalHost()
-        logger.info(lh.run(cmd))
+        logger.info(lh.run_or_die(cmd))
         logger.info(lh.run(f"chmod a+rw {dst}"))
 
     def _find_iso(self, fcos_dir: str) -> Optional[str]:
-        for root, _, files in os.walk(fcos_dir, topdown=False):
-            for name in files:
-                if name.endswith(".iso"):
-                    return os.path.join(root, name)
-        return None
+        return next(glob.iglob(os.path.join(fcos_dir, "**", "*.iso"), recursive=True), None)
 
     def _clone_if_not_exists(self, url: str) -> str:
         dest = url.split("/")[-1]
@@ -223,25 +232,35 @@ class CoreosBuilder:
 
     def create_ignition(self, public_key_dir: str = "/root/.ssh/") -> str:
         logger.info("Creating ignition")
+        key_files = tuple((file, os.stat(file).st_mtime_ns) for file in glob.glob(f"{public_key_dir}/*.pub"))
+        return _ignition_for_keys(key_files)
 
-        keys = []
-        for file in glob.glob(f"{public_key_dir}/*.pub"):
-            logger.info(f"appending key from {file}")
-            with open(file, 'r') as f:
-                key = " ".join(f.read().split(" ")[:-1])
-            keys.append(key)
-
-        ign = {"ignition": {"version": "3.3.0"}, "passwd": {"users": [{"name": "core", "sshAuthorizedKeys": keys}]}}
-        return json.dumps(ign)
+    def _ign_fingerprint(self, dst: str, ign: str) -> str:
+        # Include the iso's mtime and size so that a rebuilt/replaced iso is never skipped.
+        st = os.stat(dst)
+        return hashlib.sha256(f"{st.st_mtime_ns}:{st.st_size}:{ign}".encode()).hexdigest()
 
     def ensure_ign_embedded(self, dst: str) -> None:
+        ign = self.create_ignition()
+        fingerprint_file = dst + ".ignhash"
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file) as f:
+                if f.read() == self._ign_fingerprint(dst, ign):
+                    logger.info(f"Ignition in {dst} is up to date")
+                    return
+
         lh = host.LocalHost()
         r = lh.run(f"coreos-installer iso ignition show {dst}")
-        if r.out == self.create_ignition():
-            return
-        r = lh.run(f"coreos-installer iso ignition remove {dst}")
-        shutil.move(dst, dst + ".tmp")
-        self._embed_ign(dst + ".tmp", dst)
+        if r.out != ign:
+            lh.run_or_die(f"coreos-installer iso ignition remove {dst}")
+            shutil.move(dst, dst + ".tmp")
+            self._embed_ign(dst + ".tmp", dst)
+            # Only record the fingerprint once the iso is confirmed to carry the expected ignition.
+            if lh.run(f"coreos-installer iso ignition show {dst}").out != ign:
+                logger.error_and_exit(f"Failed to embed ignition in {dst}")
+
+        with open(fingerprint_file, "w") as f:
+            f.write(self._ign_fingerprint(dst, ign))
 
 
 def main() -> None:
@@ -2,11 +2,12 @@ from clustersConfig import ClustersConfig
 from k8sClient import K8sClient
 import host
 from common_patches import apply_common_pathches
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from extraConfigDpuInfra import run_dpu_network_operator_git
 import extraConfigSriov
 from typing import Optional
 import sys
+import functools
 import jinja2
 import json
 import os
@@ -38,11 +39,17 @@ def ExtraConfigDpuTenantMC(cc: ClustersConfig, _: ExtraConfigArgs, futures: dict
     logger.info("Need to deploy sriov network operator")
 
 
-def render_sriov_node_policy(policyname: str, bf_port: str, bf_addr: str, numvfs: int, resourcename: str, outfilename: str) -> None:
+@functools.lru_cache(maxsize=None)
+def _sriov_node_policy_template() -> jinja2.Template:
+    # The template is rendered once per policy, only compile it once.
     with open("./manifests/tenant/SriovNetworkNodePolicy.yaml.j2") as f:
-        j2_template = jinja2.Template(f.read())
-        rendered = j2_template.render(policyName=policyname, bf_port=bf_port, bf_addr=bf_addr, numVfs=numvfs, resourceName=resourcename)
-        logger.info(rendered)
+        template: jinja2.Template = jinja2.Template(f.read())
+    return template
+
+
+def render_sriov_node_policy(policyname: str, bf_port: str, bf_addr: str, numvfs: int, resourcename: str, outfilename: str) -> None:
+    rendered = _sriov_node_policy_template().render(policyName=policyname, bf_port=bf_port, bf_addr=bf_addr, numVfs=numvfs, resourceName=resourcename)
+    logger.info(rendered)
 
     with open(outfilename, "w") as outFile:
         outFile.write(rendered)
@@ -50,9 +57,7 @@ def render_sriov_node_policy(policyname: str, bf_port: str, bf_addr: str, numvfs
 
 def render_envoverrides_cm(client: K8sClient, mapping: Optional[list[dict[str, str]]], ns: str) -> str:
     assert mapping is not None
-    contents = open("manifests/tenant/envoverrides.yaml").read()
-    contents += f"{ns}\n"
-    contents += "data:\n"
+    contents = [open("manifests/tenant/envoverrides.yaml").read(), f"{ns}\n", "data:\n"]
     for e in mapping:
         a: dict[str, str] = {}
         a["TENANT_K8S_NODE"] = e["worker"]
@@ -64,11 +69,10 @@ def render_envoverrides_cm(client: K8sClient, mapping: Optional[list[dict[str, s
             logger.error(f"Failed to retrieve ip for {e['bf']}")
             sys.exit(1)
         a["MGMT_IFNAME"] = "c1pf0vf0"
-        contents += f"  {e['bf']}: |\n"
-        for k, v in a.items():
-            contents += f"    {k}={v}\n"
+        contents.append(f"  {e['bf']}: |\n")
+        contents.extend(f"    {k}={v}\n" for k, v in a.items())
 
-    open(f"/tmp/envoverrides-{ns}.yaml", "w").write(contents)
+    open(f"/tmp/envoverrides-{ns}.yaml", "w").write("".join(contents))
     return f"/tmp/envoverrides-{ns}.yaml"
 
 
@@ -121,12 +125,11 @@ def _ExtraConfigDpuTenant_common(cc: ClustersConfig, cfg: ExtraConfigArgs, futur
         if ret.returncode != 0:
             continue
 
-        d = {}
-        for part in ret.out.strip().split("\n"):
-            key, value = part.split(":", 1)
-            d[key] = value
-        if d["bus-info"].endswith(bf):
+        # Only "bus-info" is of interest, stop at the first port that matches the BF.
+        bus_info = next((line.partition(":")[2].strip() for line in ret.out.splitlines() if line.startswith("bus-info:")), "")
+        if bus_info.endswith(bf):
             bf_port = port.ifname
+            break
     logger.info(bf_port)
     if bf_port is None:
         logger.info("Couldn't find bf port")
@@ -173,27 +176,27 @@ def _ExtraConfigDpuTenant_common(cc: ClustersConfig, cfg: ExtraConfigArgs, futur
 
         logger.info("setting ovn kube node env-override to set management port")
         logger.info(os.getcwd())
-        contents = open("manifests/tenant/setenvovnkube.yaml").read()
+        contents = [open("manifests/tenant/setenvovnkube.yaml").read()]
 
         assert cfg.mapping is not None
+        mp = re.sub(r'np\d$', '', bf_port)
         for bfmap in cfg.mapping:
             a: dict[str, str] = {}
-            mp = re.sub(r'np\d$', '', bf_port)
             a["OVNKUBE_NODE_MGMT_PORT_NETDEV"] = f"{mp}v0"
-            contents += f"  {bfmap['worker']}: |\n"
-            for k, v in a.items():
-                contents += f"    {k}={v}\n"
-        open("/tmp/1.yaml", "w").write(contents)
+            contents.append(f"  {bfmap['worker']}: |\n")
+            contents.extend(f"    {k}={v}\n" for k, v in a.items())
+        open("/tmp/1.yaml", "w").write("".join(contents))
 
         logger.info("Running create")
         logger.info(tclient.oc("create -f /tmp/1.yaml"))
 
-    for e in cc.workers:
-        cmd = f"label node {e.name} network.operator.openshift.io/dpu-host="
-        logger.info(tclient.oc(cmd))
-        ip = tclient.get_ip(e.name)
+    worker_names = " ".join(e.name for e in cc.workers)
+    logger.info(tclient.oc(f"label node {worker_names} network.operator.openshift.io/dpu-host="))
+
+    def remove_mgmt_port(name: str) -> None:
+        ip = tclient.get_ip(name)
         if ip is None:
-            logger.error(f"Failed to get ip for node {e.name}")
+            logger.error(f"Failed to get ip for node {name}")
             sys.exit(-1)
         rh = host.RemoteHost(ip)
         rh.ssh_connect("core")
@@ -210,6 +213,12 @@ def _ExtraConfigDpuTenant_common(cc: ClustersConfig, cfg: ExtraConfigArgs, futur
         # workaround for https://issues.redhat.com/browse/NHE-335
         logger.info(rh.run("sudo ovs-vsctl del-port br-int ovn-k8s-mp0"))
 
+    # Connecting to the workers dominates here, do it for all of them in parallel.
+    executor = ThreadPoolExecutor(max_workers=len(cc.workers))
+    mgmt_port_futures = [executor.submit(remove_mgmt_port, e.name) for e in cc.workers]
+    for future in mgmt_port_futures:
+        future.result()
+
     logger.info("creating mc to disable ovs")
     if not new_api:
         # At this point we error out, because the patch ports on the DPU OvS side does not get created
@@ -380,7 +380,7 @@ class Host:
         logger.info(f"Waited for {t.elapsed()} for {self.hostname()} to respond")
 
     def ping(self) -> bool:
-        lh = Host("localhost")
+        lh = LocalHost()
         ping_cmd = f"timeout 1 ping -4 -c 1 {self._hostname}"
         r = lh.run(ping_cmd)
         return r.returncode == 0
@@ -557,7 +557,10 @@ def sync_time(src: Host, dst: Host) -> Result:
     return dst.run(f"sudo date -s \"{date}\"")
 
 
+@lru_cache(maxsize=None)
 def LocalHost() -> Host:
+    # Host instances are shared per hostname, but constructing one again re-runs
+    # __init__ (resetting its lock and state). Only construct the local one once.
     return Host("localhost")
 
 
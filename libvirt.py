@@ -31,6 +31,19 @@ class Libvirt:
         for service in MODULAR_SERVICES:
             self._enable_modular(service)
 
+    def is_configured(self) -> bool:
+        # True if everything configure() sets up is already in place. Socket activated daemons
+        # exit when idle, so only their enablement and sockets are checked, not the daemons themselves.
+        if self._service_is_active("libvirtd.service") or self._service_is_enabled("libvirtd.service"):
+            return False
+
+        services = [f"virt{service}d.service" for service in MODULAR_SERVICES]
+        sockets = [f"virt{service}d{suffix}" for service in MODULAR_SERVICES for suffix in MODULAR_SOCKET_SUFFIXES]
+        # systemctl prints one state per unit, query them all at once.
+        enabled = self.hostconn.run(f"systemctl is-enabled {' '.join(services + sockets)}").out.split()
+        active = self.hostconn.run(f"systemctl is-active {' '.join(sockets)}").out.split()
+        return enabled == ["enabled"] * len(services + sockets) and active == ["active"] * len(sockets)
+
     def restart(self, service: Optional[str] = None) -> None:
         if service is not None:
             self.hostconn.run_or_die(f"systemctl restart virt{service}d.service")
@@ -46,6 +46,11 @@ def check_test5(tfile: TFileConfig, cc: clustersConfig.ClustersConfig) -> None:
     ]
 
 
+def check_test12(tfile: TFileConfig, cc: clustersConfig.ClustersConfig) -> None:
+    assert cc.kubeconfig == "/root/kubeconfig.mycluster"
+    assert [m.name for m in cc.masters] == ['mycluster-master-1']
+
+
 TFILES = (
     TFileConfig("tests/configs/test1.yaml"),
     TFileConfig("tests/configs/test2.yaml"),
@@ -58,6 +63,7 @@ TFILES = (
     TFileConfig("tests/configs/test9.yaml"),
     TFileConfig("tests/configs/test10.yaml"),
     TFileConfig("tests/configs/test11.yaml"),
+    TFileConfig("tests/configs/test12.yaml", check_test12),
     TFileConfig("microshift.yml"),
 )
 
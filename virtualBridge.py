@@ -1,18 +1,27 @@
 import os
 import re
+import shlex
 import time
 import json
 
-from typing import Optional
+from typing import Callable, Optional
 import xml.etree.ElementTree as et
-from pathlib import Path
 from logger import logger
 
 import common
 import host
+import timer
 from clustersConfig import BridgeConfig, NodeConfig
 from libvirt import Libvirt
 
+_QEMU_USER_ROOT_RE = re.compile('\nuser = "root"')
+_QEMU_GROUP_ROOT_RE = re.compile('\ngroup = "root"')
+_QEMU_CONF = "/etc/libvirt/qemu.conf"
+_NET_UPDATE = "net-update default"
+
+# hostname -> (mtime of qemu.conf, whether qemu runs as root), shared by all VirBridge instances.
+_qemu_conf_root_cache: dict[str, tuple[str, bool]] = {}
+
 
 def bridge_dhcp_range_str(dhcp_range: Optional[tuple[str, str]]) -> str:
     if dhcp_range is not None:
@@ -20,8 +29,25 @@ def bridge_dhcp_range_str(dhcp_range: Optional[tuple[str, str]]) -> str:
     return ""
 
 
-def bridge_ip_address_str(ip: str, mask: str) -> str:
-    return f"<ip address='{ip}' netmask='{mask}'>"
+class VirBridgeError(RuntimeError):
+    """
+    Raised when a command on the virtual bridge itself fails.
+
+    Failures of the libvirt services (see Libvirt) still exit directly. cda.py converts uncaught
+    VirBridgeErrors to an exit.
+    """
+
+
+def dhcp_host_str(mac: str, name: str, ip: str) -> str:
+    return f"<host mac='{mac}' name='{name}' ip='{ip}'/>"
+
+
+def net_update_args(command: str, section: str, xml: str) -> str:
+    return f"{_NET_UPDATE} {command} {section} \"{xml}\" --live --config"
+
+
+def net_update_cmd(command: str, section: str, xml: str) -> str:
+    return f"virsh {net_update_args(command, section, xml)}"
 
 
 class VirBridge:
@@ -39,23 +65,89 @@ class VirBridge:
         self.hostconn = h
         self.config = config
         self.libvirt = Libvirt(h)
+        self._net_xml: Optional[str] = None
+        self._net_elem: Optional[et.Element] = None
+
+    def _net_dumpxml(self) -> str:
+        # Every "virsh" call forks a process (over ssh for remote hosts). Reuse the
+        # dump until the network is modified, see _invalidate_net_xml().
+        # The persistent definition is enough, every update is applied with --config as well.
+        if self._net_xml is None:
+            ret = self.hostconn.run("virsh net-dumpxml default --inactive")
+            if ret.returncode != 0:
+                return ret.out
+            self._net_xml = ret.out
+        return self._net_xml
+
+    def _net_element(self) -> Optional[et.Element]:
+        # Parsed form of _net_dumpxml(), None if the network doesn't exist.
+        if self._net_elem is None:
+            xml_str = self._net_dumpxml()
+            if not xml_str.strip():
+                return None
+            self._net_elem = et.fromstring(xml_str)
+        return self._net_elem
+
+    def _invalidate_net_xml(self) -> None:
+        self._net_xml = None
+        self._net_elem = None
+
+    def _net_update(self, *updates: tuple[str, str, str], must_succeed: bool = False) -> host.Result:
+        # Single place through which the network is modified, mirroring libvirt's virNetworkUpdate().
+        # Each update is a (command, section, xml) tuple. Several updates are run by a single virsh
+        # process over a single libvirt connection. virsh runs all of them and reports the status of
+        # the last one.
+        if len(updates) == 1:
+            cmd = net_update_cmd(*updates[0])
+        else:
+            cmd = f"virsh {shlex.quote('; '.join(net_update_args(*u) for u in updates))}"
+        ret = self.hostconn.run(cmd)
+        self._invalidate_net_xml()
+        if must_succeed and not ret.success():
+            raise VirBridgeError(f"Failed to update network default on {self.hostconn.hostname()}: {ret.err}")
+        return ret
+
+    def _dhcp_hosts(self) -> list[et.Element]:
+        net = self._net_element()
+        return [] if net is None else net.findall("./ip/dhcp/host")
+
+    def _dhcp_range(self) -> Optional[et.Element]:
+        net = self._net_element()
+        return None if net is None else net.find("./ip/dhcp/range")
+
+    def _stp_off(self) -> bool:
+        net = self._net_element()
+        bridge = None if net is None else net.find("./bridge")
+        return bridge is not None and bridge.get("stp") == "off"
+
+    def _has_bridge_ip(self, ip: str, mask: str) -> bool:
+        net = self._net_element()
+        return net is not None and any(e.get("address") == ip and e.get("netmask") == mask for e in net.findall("./ip"))
 
     def setup_dhcp_entries(self, nodes: list[NodeConfig]) -> None:
         # DHCP entries should have been removed during teardown.
         # However, leases sometimes came back.
         self.remove_dhcp_entries(nodes)
+        cmds = []
         for cfg in nodes:
-            if cfg.ip is None:
-                logger.debug(f"Missing IP for node {cfg.name}, skipping...")
+            ip, mac, name = cfg.ip, cfg.mac, cfg.name
+            if ip is None:
+                logger.debug(f"Missing IP for node {name}, skipping...")
                 continue
-            ip = cfg.ip
-            mac = cfg.mac
-            name = cfg.name
 
-            host_xml = f"<host mac='{mac}' name='{name}' ip='{ip}'/>"
             logger.info(f"Creating static DHCP entry for VM {name}, ip {ip} mac {mac}")
-            cmd = f"virsh net-update default add ip-dhcp-host \"{host_xml}\" --live --config"
-            self.hostconn.run_or_die(cmd)
+            cmds.append(net_update_cmd("add", "ip-dhcp-host", dhcp_host_str(mac, name, ip)))
+        self._run_batched(cmds)
+
+    def _run_batched(self, cmds: list[str]) -> None:
+        # Run all commands in a single process spawn (single ssh round-trip for remote
+        # hosts), stopping at the first one that fails.
+        if not cmds:
+            return
+        ret = self.hostconn.run(f"bash -c {shlex.quote(' && '.join(cmds))}")
+        self._invalidate_net_xml()
+        if not ret.success():
+            raise VirBridgeError(f"Failed to update network default on {self.hostconn.hostname()}: {ret.err}")
 
     def remove_dhcp_entries(self, nodes: list[NodeConfig]) -> None:
         def filter_dhcp_leases(j: list[dict[str, str]], removed_macs: list[str], names: list[str]) -> list[dict[str, str]]:
@@ -71,165 +163,207 @@ class VirBridge:
                 filtered.append(entry)
             return filtered
 
-        xml_str = self.hostconn.run("virsh net-dumpxml default").out
-        q = et.fromstring(xml_str)
+        # Other VirBridge instances might have changed the network in the meantime.
+        self._invalidate_net_xml()
         removed_macs = []  # type: list[str]
+        deletes = []
         names = [node.name for node in nodes]
         ips = [node.ip for node in nodes if node.ip]
-        ip_tree = next((it for it in q.iter("ip")), et.Element(''))
-        dhcp = next((it for it in ip_tree.iter("dhcp")), et.Element(''))
-        for e in dhcp:
+        for e in self._dhcp_hosts():
             if e.get('name') in names or e.get('ip') in ips:
                 # For all dhcp entries, check whether the name or the ip has been assigned to one of our "vms", and remove it if it's the case.
-                mac = e.attrib["mac"]
-                name = e.attrib["name"]
-                ip = e.attrib["ip"]
-                pre = "virsh net-update default delete ip-dhcp-host"
-                cmd = f"{pre} \"<host mac='{mac}' name='{name}' ip='{ip}'/>\" --live --config"
-                result = self.hostconn.run(cmd)
-                logger.info(f"Delete DHCP configuration for {name}: {result}")
+                mac, name, ip = e.attrib["mac"], e.attrib["name"], e.attrib["ip"]
+                logger.info(f"Deleting DHCP configuration for {name}")
+                deletes.append(("delete", "ip-dhcp-host", dhcp_host_str(mac, name, ip)))
                 removed_macs.append(mac)
+        if deletes:
+            result = self._net_update(*deletes)
+            logger.info(f"Delete DHCP configuration: {result}")
 
         fn = "/var/lib/libvirt/dnsmasq/virbr0.status"
-        p = Path(fn)
-        with p.open() as f:
-            contents = f.read()
+        # Read through hostconn, the lease file lives on the host running the bridge.
+        contents = self.hostconn.read_file(fn)
 
-        if contents:
+        if contents.strip():
             j = json.loads(contents)
             names = [node.name for node in nodes]
             logger.info(f'Cleaning up {fn}')
             logger.info(f'removing hosts with mac in {removed_macs} or name in {names}')
             filtered = filter_dhcp_leases(j, removed_macs, names)
+            if len(filtered) == len(j):
+                # Nothing to drop, no need to bounce the network and qemu.
+                return
             result = self.hostconn.run("virsh net-destroy default")
             logger.info(f"Delete \"default\" Libvirt network: {result}")
 
-            with p.open("w") as f:
-                f.write(json.dumps(filtered, indent=4))
+            self.hostconn.write(fn, json.dumps(filtered, indent=4))
             result = self.hostconn.run("virsh net-start default")
             logger.info(f"Start \"default\" Libvirt network: {result}")
+            self._invalidate_net_xml()
             self.libvirt.restart("qemu")
 
     def _ensure_started(self, bridge_xml: str, api_port: Optional[str]) -> None:
-        cmd = "virsh net-destroy default"
-        self.hostconn.run(cmd)  # ignore return code - it might fail if net was not started
-
-        cmd = "virsh net-undefine default"
-        ret = self.hostconn.run(cmd)
-        if ret.returncode != 0 and "Network not found" not in ret.err:
-            logger.error_and_exit(str(ret))
-
-        # Fix cases where virsh net-start fails with error "... interface virbr0: File exists"
-        cmd = "ip link delete virbr0"
-        self.hostconn.run(cmd)  # ignore return code - it might fail if virbr did not exist
-
-        cmd = f"virsh net-define {bridge_xml}"
-        self.hostconn.run_or_die(cmd)
-
+        # All steps run in a single process spawn (single ssh round-trip for remote hosts).
+        script = [
+            # ignore return code - it might fail if net was not started
+            "virsh net-destroy default",
+            # only a missing network is an acceptable failure of net-undefine
+            "out=$(virsh net-undefine default 2>&1) || echo \"$out\" | grep -q 'Network not found' || { echo \"$out\" >&2; exit 1; }",
+            # Fix cases where virsh net-start fails with error "... interface virbr0: File exists"
+            # net-destroy usually removed it already, only spawn "ip" if it is still there
+            "! test -e /sys/class/net/virbr0 || ip link delete virbr0",
+            "set -e",
+            f"virsh net-define {bridge_xml}",
+        ]
         if api_port is not None:
             # set interface down before starting bridge as otherwise bridge start might fail if interface
             # already got an IP address in same network as bridge
-            self.hostconn.run(f"ip link set {api_port} down")
+            script.append(f"ip link set {api_port} down || true")
 
-        cmd = "virsh net-start default"
-        self.hostconn.run_or_die(cmd)
+        script.append("virsh net-start default")
 
         if api_port is not None:
-            self.hostconn.run(f"ip link set {api_port} up")
+            script.append(f"ip link set {api_port} up || true")
+
+        ret = self.hostconn.run(f"bash -c {shlex.quote('; '.join(script))}")
+        self._invalidate_net_xml()
+        if not ret.success():
+            raise VirBridgeError(f"Failed to recreate network default on {self.hostconn.hostname()}: {ret.err}")
+
+    def _wait_for(self, name: str, predicate: Callable[[], bool], timeout: str = "10s", interval: float = 0.25) -> bool:
+        t = timer.Timer(timeout)
+        while not predicate():
+            if t.triggered():
+                logger.warning(f"Timeout after {t.elapsed()} waiting for {name} on {self.hostconn.hostname()}")
+                return False
+            time.sleep(interval)
+        return True
+
+    def _net_is_active(self) -> bool:
+        ret = self.hostconn.run("virsh net-info default")
+        return ret.success() and re.search(r"^Active:\s+yes", ret.out, re.MULTILINE) is not None
 
     def _network_xml(self) -> str:
-        if self.config.dynamic_ip_range is None:
-            dhcp_part = ""
+        net = et.Element("network")
+        et.SubElement(net, "name").text = "default"
+        et.SubElement(net, "forward", mode="nat")
+        et.SubElement(net, "bridge", name="virbr0", stp="off", delay="0")
+        ip = et.SubElement(net, "ip", address=self.config.ip, netmask=self.config.mask)
+        if self.config.dynamic_ip_range is not None:
+            start, end = self.config.dynamic_ip_range
+            et.SubElement(et.SubElement(ip, "dhcp"), "range", start=start, end=end)
+        return et.tostring(net, encoding="unicode")
+
+    def _runs_as_root(self) -> bool:
+        if self.hostconn.is_localhost():
+            mtime = str(int(os.stat(_QEMU_CONF).st_mtime))
         else:
-            dhcp_part = f"""<dhcp>
-                {bridge_dhcp_range_str(self.config.dynamic_ip_range)}
-                </dhcp>"""
-
-        return f"""
-                <network>
-                <name>default</name>
-                <forward mode='nat'/>
-                <bridge name='virbr0' stp='off' delay='0'/>
-                {bridge_ip_address_str(self.config.ip, self.config.mask)}
-                {dhcp_part}
-                </ip>
-                </network>"""
+            # Much smaller than transferring the whole file over ssh.
+            mtime = self.hostconn.run(f"stat -c %Y {_QEMU_CONF}").out.strip()
+        key = self.hostconn.hostname()
+        cached = _qemu_conf_root_cache.get(key)
+        if mtime and cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        qemu_conf = self.hostconn.read_file(_QEMU_CONF)
+        runs_as_root = _QEMU_USER_ROOT_RE.search(qemu_conf) is not None and _QEMU_GROUP_ROOT_RE.search(qemu_conf) is not None
+        if mtime:
+            _qemu_conf_root_cache[key] = (mtime, runs_as_root)
+        return runs_as_root
 
     def _ensure_run_as_root(self) -> None:
-        qemu_conf = self.hostconn.read_file("/etc/libvirt/qemu.conf")
-        if re.search('\nuser = "root"', qemu_conf) and re.search('\nuser = "root"', qemu_conf):
+        if self._runs_as_root():
             return
-        self.hostconn.run("sed -e 's/#\\(user\\|group\\) = \".*\"$/\\1 = \"root\"/' -i /etc/libvirt/qemu.conf")
-        self.libvirt.restart("qemu")
-
-    def configure(self, api_port: Optional[str]) -> None:
-        hostname = self.hostconn.hostname()
-        self.libvirt.configure()
-
-        self._ensure_run_as_root()
+        # "w /dev/stdout" prints the lines sed changed, so qemu is only restarted if the config really changed.
+        ret = self.hostconn.run(f"sed -e 's/#\\(user\\|group\\) = \".*\"$/\\1 = \"root\"/w /dev/stdout' -i {_QEMU_CONF}")
+        _qemu_conf_root_cache.pop(self.hostconn.hostname(), None)
+        if ret.out.strip():
+            self.libvirt.restart("qemu")
 
+    def _reconfigure_reasons(self) -> list[str]:
         # stp must be disabled or it might conflict with default configuration of some physical switches
         # 'bridge' section of network 'default' can't be updated => destroy and recreate
         # check that default exists and contains stp=off
-        cmd = "virsh net-dumpxml default"
-        ret = self.hostconn.run(cmd)
-
-        needs_reconfigure = False
+        net = self._net_element()
+        if net is None:
+            return ["network default not found"]
 
-        expected_dhcp_range = bridge_dhcp_range_str(self.config.dynamic_ip_range)
-
-        if not expected_dhcp_range and "dhcp" in ret.out:
-            logger.info("Bridge needs to be reconfigured: unexpected dhcp range present")
-            needs_reconfigure = True
+        reasons = []
+        if self.config.dynamic_ip_range is None and net.find("./ip/dhcp") is not None:
+            reasons.append("unexpected dhcp range present")
 
         # Make sure STP is off on the virtual bridge.
-        if "stp='off'" not in ret.out:
-            logger.info("Bridge needs to be reconfigured: stp enabled")
-            needs_reconfigure = True
+        if not self._stp_off():
+            reasons.append("stp enabled")
 
         # Make sure the correct bridge IP is configured.
-        if bridge_ip_address_str(self.config.ip, self.config.mask) not in ret.out:
-            logger.info("Bridge needs to be reconfigured: unexpected bridge IP")
-            needs_reconfigure = True
+        if not self._has_bridge_ip(self.config.ip, self.config.mask):
+            reasons.append("unexpected bridge IP")
+        return reasons
+
+    def _dhcp_range_matches(self) -> bool:
+        if self.config.dynamic_ip_range is None:
+            return True
+        range_elem = self._dhcp_range()
+        return range_elem is not None and (range_elem.get("start"), range_elem.get("end")) == self.config.dynamic_ip_range
+
+    def _is_configured(self) -> bool:
+        # Cheapest checks first: a single net-dumpxml answers most of them.
+        return not self._reconfigure_reasons() and self._dhcp_range_matches() and self._net_is_active() and self._runs_as_root() and self.libvirt.is_configured()
+
+    def configure(self, api_port: Optional[str]) -> None:
+        hostname = self.hostconn.hostname()
+
+        self._invalidate_net_xml()
+        if self._is_configured():
+            logger.info(f"Bridge already configured on {hostname}")
+            return
+
+        self.libvirt.configure()
+
+        self._ensure_run_as_root()
 
-        if needs_reconfigure:
+        self._invalidate_net_xml()
+        reasons = self._reconfigure_reasons()
+        for reason in reasons:
+            logger.info(f"Bridge needs to be reconfigured: {reason}")
+
+        if reasons:
             logger.info("Destoying and recreating bridge")
             logger.info(f"creating default-net.xml on {hostname}")
             contents = self._network_xml()
 
             bridge_xml = os.path.join("/tmp", 'vir_bridge.xml')
             self.hostconn.write(bridge_xml, contents)
-            # Not sure why/whether this is needed. But we saw failures w/o it.
-            # Without this, net-undefine within ensure_bridge_is_started fails as libvirtd fails to restart
-            # We need to investigate how to remove the sleep to speed up
-            time.sleep(5)
+            # Without this, net-undefine within _ensure_started fails as libvirt is not yet back
+            # up after being (re)configured. Wait until it answers instead of a fixed sleep.
+            self._wait_for("libvirt networks to be available", lambda: self.hostconn.run("virsh net-list --all").success())
             self._ensure_started(bridge_xml, api_port)
 
             self.libvirt.restart()
 
-            # Not sure why/whether this is needed. But we saw failures w/o it.
-            # We need to investigate how to remove the sleep to speed up
-            time.sleep(5)
+            self._wait_for("network default to be active", self._net_is_active)
+            # The network was just defined from _network_xml(), with the expected dynamic range already.
+            return
 
         # Reconfiguring bridge by deleting and recreating it causes existing bridge configuration (dhcp entries, bridge masters...) to get lost.
         # The dynamic range might change if we add workers. Update dynamic range ... dynamically, without restarting bridge, to avoid
         # losing existing bridge config.
+        self._update_dhcp_range()
+
+    def _update_dhcp_range(self) -> None:
+        if self.config.dynamic_ip_range is None or self._dhcp_range_matches():
+            return
 
+        range_elem = self._dhcp_range()
         # We can't modify the dhcp range, but we can delete/add it back. First delete it.
-        range_elem = None
-        xml_str = ""
-        if expected_dhcp_range not in ret.out:
-            tree = et.fromstring(ret.out)
-            range_elem = next((it for it in tree.iter('range')), et.Element(''))
-            for attr in range_elem.attrib:
-                xml_str = xml_str + f"{attr}='{range_elem.attrib[attr]}' "
-            if range_elem.tag:
-                xml_str = f"\"<range {xml_str}/>\""
-                cmd = f"virsh net-update default delete ip-dhcp-range {xml_str} --live --config"
-                self.hostconn.run(cmd)
-
-            cmd = f"virsh net-update default add ip-dhcp-range \"{expected_dhcp_range}\" --live --config"
-            self.hostconn.run_or_die(cmd)
+        # The delete is allowed to fail, only the add (run last) decides the outcome.
+        updates = []
+        if range_elem is not None:
+            attrs = "".join(f"{attr}='{value}' " for attr, value in range_elem.attrib.items())
+            updates.append(("delete", "ip-dhcp-range", f"<range {attrs}/>"))
+        updates.append(("add", "ip-dhcp-range", bridge_dhcp_range_str(self.config.dynamic_ip_range)))
+        self._net_update(*updates, must_succeed=True)
 
     def eth_address(self) -> str:
         max_tries = 3
@@ -242,5 +376,4 @@ class VirBridge:
                 return bridge_port.address
             time.sleep(5)
 
-        logger.error_and_exit(f"Failed to get the virbr0 ethernet address on {self.hostconn.hostname()}")
-        return ""
+        raise VirBridgeError(f"Failed to get the virbr0 ethernet address on {self.hostconn.hostname()}")